@@ -1,14 +1,33 @@
-from collections import defaultdict
-from itertools import permutations
+from collections import defaultdict, deque
+from itertools import chain
+from weakref import WeakKeyDictionary
 import numpy as np
+from numba import njit
 import matplotlib.pyplot as plt
 from matplotlib.path import Path
 from matplotlib.tri import Triangulation
 from scipy.interpolate import RectBivariateSpline
+from scipy.ndimage import map_coordinates
 from shapely.geometry import Polygon, MultiPolygon
 from jigsawpy import jigsaw_msh_t
 
 
+# Triangulations are cached per mesh instance together with the vert2 and
+# tria3 arrays they were built from, and reused only while mesh.vert2 and
+# mesh.tria3 are still those same objects. Holding the arrays keeps their
+# buffers from being recycled while the entry exists. Functions here that
+# reassign them call _invalidate_tri(mesh) to release the old arrays early.
+# In-place edits (e.g. mesh.tria3['index'][...] = ...) are not detected:
+# the cached Triangulation holds its own copy of the triangles. Call
+# _invalidate_tri(mesh) after any such edit. Nothing in this package edits
+# vert2 or tria3 in place.
+_tri_cache = WeakKeyDictionary()
+
+
+def _invalidate_tri(mesh):
+    _tri_cache.pop(mesh, None)
+
+
 def mesh_to_tri(mesh):
     """
     mesh is a jigsawpy.jigsaw_msh_t() instance.
@@ -19,41 +38,69 @@ def mesh_to_tri(mesh):
         mesh.tria3['index'])
 
 
+def _cached_tri(mesh):
+    """
+    Triangulation of mesh shared by the helpers in this module, along with
+    its lazily computed neighbors and edges tables, for as long as the mesh
+    is unmodified; see the note on _tri_cache. It is never handed out to
+    callers, since e.g. Triangulation.set_mask() would change the boundary
+    rings derived from it.
+    """
+    cached = _tri_cache.get(mesh)
+    if cached is not None:
+        vert2, tria3, tri = cached
+        if vert2 is mesh.vert2 and tria3 is mesh.tria3:
+            return tri
+    tri = mesh_to_tri(mesh)
+    _tri_cache[mesh] = (mesh.vert2, mesh.tria3, tri)
+    return tri
+
+
+def renumber_index(index, used_indexes, nverts):
+    """
+    Maps the vertex indexes in index to their position in the sorted array
+    used_indexes, i.e. the numbering the vertices get once every vertex not
+    in used_indexes is dropped from the vertex table.
+    """
+    if used_indexes.size == nverts:
+        # every vertex is used, the numbering does not change
+        return index
+    lut = np.full((nverts,), -1, dtype=index.dtype)
+    lut[used_indexes] = np.arange(used_indexes.size, dtype=index.dtype)
+    return lut[index]
+
+
 def cleanup_isolates(mesh):
-    node_indexes = np.arange(mesh.vert2['coord'].shape[0])
     used_indexes = np.unique(mesh.tria3['index'])
-    vert2_idxs = np.where(
-        np.isin(node_indexes, used_indexes, assume_unique=True))[0]
-    tria3_idxs = np.where(
-        ~np.isin(node_indexes, used_indexes, assume_unique=True))[0]
-    tria3 = mesh.tria3['index'].flatten()
-    for idx in reversed(tria3_idxs):
-        _idx = np.where(tria3 >= idx)
-        tria3[_idx] = tria3[_idx] - 1
-    tria3 = tria3.reshape(mesh.tria3['index'].shape)
-    mesh.vert2 = mesh.vert2.take(vert2_idxs, axis=0)
-    if len(mesh.value) > 0:
-        mesh.value = mesh.value.take(vert2_idxs)
-    mesh.tria3 = np.asarray(
-        [(tuple(indices), mesh.tria3['IDtag'][i])
-         for i, indices in enumerate(tria3)],
-        dtype=jigsaw_msh_t.TRIA3_t)
+    tria3 = renumber_index(
+        mesh.tria3['index'], used_indexes, mesh.vert2['coord'].shape[0])
+    if used_indexes.size < mesh.vert2.shape[0]:
+        mesh.vert2 = mesh.vert2.take(used_indexes, axis=0)
+        if len(mesh.value) > 0:
+            mesh.value = mesh.value.take(used_indexes)
+    elif len(mesh.value) > 0:
+        # same 1-D shape take() returns, without the copy
+        mesh.value = mesh.value.ravel()
+    tria3_IDtag = mesh.tria3['IDtag']
+    mesh.tria3 = np.empty(tria3.shape[0], dtype=jigsaw_msh_t.TRIA3_t)
+    mesh.tria3['index'] = tria3
+    mesh.tria3['IDtag'] = tria3_IDtag
+    _invalidate_tri(mesh)
 
 
 def put_edge2(mesh):
-    tri = Triangulation(
-        mesh.vert2['coord'][:, 0],
-        mesh.vert2['coord'][:, 1],
-        mesh.tria3['index'])
-    mesh.edge2 = np.array(
-        [(edge, 0) for edge in tri.edges], dtype=jigsaw_msh_t.EDGE2_t)
+    tri = _cached_tri(mesh)
+    mesh.edge2 = np.empty(tri.edges.shape[0], dtype=jigsaw_msh_t.EDGE2_t)
+    mesh.edge2['index'] = tri.edges
+    mesh.edge2['IDtag'] = 0
 
 
-def geom_to_multipolygon(mesh):
+def geom_to_multipolygon(mesh, ring_collection=None):
     vertices = mesh.vert2['coord']
-    _index_ring_collection = index_ring_collection(mesh)
+    if ring_collection is None:
+        ring_collection = index_ring_collection(mesh)
     polygon_collection = list()
-    for polygon in _index_ring_collection.values():
+    for polygon in ring_collection.values():
         exterior = vertices[polygon['exterior'][:, 0], :]
         interiors = list()
         for interior in polygon['interiors']:
@@ -62,16 +109,35 @@ def geom_to_multipolygon(mesh):
     return MultiPolygon(polygon_collection)
 
 
-def needs_sieve(mesh, area=None):
-    areas = [polygon.area for polygon in geom_to_multipolygon(mesh)]
+def _ring_area_and_bounds(ring_collection, vertices):
+    """
+    Area (exterior minus interiors) and exterior bounding box as
+    (xmin, ymin, xmax, ymax) of every polygon in ring_collection, computed
+    directly from the ring indexes.
+    """
+    areas = np.empty((len(ring_collection),))
+    bounds = np.empty((len(ring_collection), 4))
+    for i, polygon in enumerate(ring_collection.values()):
+        exterior = vertices[polygon['exterior'][:, 0], :]
+        areas[i] = abs(signed_polygon_area(exterior)) - sum(
+            abs(signed_polygon_area(vertices[interior[:, 0], :]))
+            for interior in polygon['interiors'])
+        bounds[i, :2] = np.min(exterior, axis=0)
+        bounds[i, 2:] = np.max(exterior, axis=0)
+    return areas, bounds
+
+
+def _sieve_indexes(areas, area=None):
     if area is None:
-        remove = np.where(areas < np.max(areas))[0].tolist()
-    else:
-        remove = list()
-        for idx, patch_area in enumerate(areas):
-            if patch_area <= area:
-                remove.append(idx)
-    if len(remove) > 0:
+        return np.where(areas < np.max(areas))[0]
+    return np.where(areas <= area)[0]
+
+
+def needs_sieve(mesh, area=None, ring_collection=None):
+    if ring_collection is None:
+        ring_collection = index_ring_collection(mesh)
+    areas, _ = _ring_area_and_bounds(ring_collection, mesh.vert2['coord'])
+    if len(_sieve_indexes(areas, area)) > 0:
         return True
     else:
         return False
@@ -79,70 +145,76 @@ def needs_sieve(mesh, area=None):
 
 def put_IDtags(mesh):
     # start enumerating on 1 to avoid issues with indexing on fortran models
-    mesh.vert2 = np.array(
-        [(coord, id+1) for id, coord in enumerate(mesh.vert2['coord'])],
-        dtype=jigsaw_msh_t.VERT2_t
-        )
-    mesh.tria3 = np.array(
-        [(index, id+1) for id, index in enumerate(mesh.tria3['index'])],
-        dtype=jigsaw_msh_t.TRIA3_t
-        )
-    mesh.quad4 = np.array(
-        [(index, id+1) for id, index in enumerate(mesh.quad4['index'])],
-        dtype=jigsaw_msh_t.QUAD4_t
-        )
-    mesh.hexa8 = np.array(
-        [(index, id+1) for id, index in enumerate(mesh.hexa8['index'])],
-        dtype=jigsaw_msh_t.HEXA8_t
-        )
+    vert2 = np.empty(mesh.vert2.shape[0], dtype=jigsaw_msh_t.VERT2_t)
+    vert2['coord'] = mesh.vert2['coord']
+    vert2['IDtag'] = np.arange(1, vert2.shape[0]+1)
+    mesh.vert2 = vert2
+    for geom, dtype in [('tria3', jigsaw_msh_t.TRIA3_t),
+                        ('quad4', jigsaw_msh_t.QUAD4_t),
+                        ('hexa8', jigsaw_msh_t.HEXA8_t)]:
+        index = getattr(mesh, geom)['index']
+        elements = np.empty(index.shape[0], dtype=dtype)
+        elements['index'] = index
+        elements['IDtag'] = np.arange(1, index.shape[0]+1)
+        setattr(mesh, geom, elements)
+    _invalidate_tri(mesh)
 
 
 def finalize_mesh(mesh, sieve_area=None):
     cleanup_isolates(mesh)
-    while needs_sieve(mesh) or has_pinched_nodes(mesh):
-        cleanup_pinched_nodes(mesh)
-        sieve(mesh, sieve_area)
-        
+    while True:
+        # The ring collection is computed once per pass and shared by the
+        # checks and by sieve(), unless the mesh changed in between.
+        ring_collection = index_ring_collection(mesh)
+        pinched = has_pinched_nodes(mesh, ring_collection)
+        if not (needs_sieve(mesh, ring_collection=ring_collection)
+                or pinched):
+            break
+        if pinched:
+            cleanup_pinched_nodes(mesh, ring_collection)
+            ring_collection = None
+        sieve(mesh, sieve_area, ring_collection)
+
     # cleanup_isolates(mesh)
     put_IDtags(mesh)
 
 
-def sieve(mesh, area=None):
+def sieve(mesh, area=None, ring_collection=None):
     """
     A mesh can consist of multiple separate subdomins on as single structure.
     This functions removes subdomains which are equal or smaller than the
     provided area. Default behaviours is to remove all subdomains except the
     largest one.
     """
-    # select the nodes to remove based on multipolygon areas
-    multipolygon = geom_to_multipolygon(mesh)
-    areas = [polygon.area for polygon in multipolygon]
-    if area is None:
-        remove = np.where(areas < np.max(areas))[0].tolist()
-    else:
-        remove = list()
-        for idx, patch_area in enumerate(areas):
-            if patch_area <= area:
-                remove.append(idx)
+    # select the nodes to remove based on polygon areas
+    if ring_collection is None:
+        ring_collection = index_ring_collection(mesh)
+    coords = mesh.vert2['coord']
+    areas, bounds = _ring_area_and_bounds(ring_collection, coords)
+    exteriors = [polygon['exterior'] for polygon in ring_collection.values()]
 
     # if the path surrounds the node, these need to be removed.
-    vert2_mask = np.full((mesh.vert2['coord'].shape[0],), False)
-    for idx in remove:
-        path = Path(multipolygon[idx].exterior.coords, closed=True)
-        vert2_mask = vert2_mask | path.contains_points(mesh.vert2['coord'])
+    # Only the nodes inside the polygon's bounding box can be surrounded, so
+    # the point-in-polygon test is restricted to those.
+    vert2_mask = np.full((coords.shape[0],), False)
+    for idx in _sieve_indexes(areas, area):
+        xmin, ymin, xmax, ymax = bounds[idx]
+        cand = np.where(
+            (coords[:, 0] >= xmin) & (coords[:, 0] <= xmax) &
+            (coords[:, 1] >= ymin) & (coords[:, 1] <= ymax))[0]
+        path = _ring_path(coords, exteriors[idx])
+        vert2_mask[cand[path.contains_points(coords[cand])]] = True
 
     # select any connected nodes; these ones are missed by
     # path.contains_point() because they are at the path edges.
     _node_neighbors = vertices_around_vertex(mesh)
-    _idxs = np.where(vert2_mask)[0]
-    for _idx in _idxs:
-        vert2_mask[list(_node_neighbors[_idx])] = True
+    degree = np.diff(_node_neighbors.offsets)
+    rows = np.repeat(np.arange(degree.size), degree)
+    vert2_mask[_node_neighbors.indices[vert2_mask[rows]]] = True
 
     # Also, there might be some dangling triangles without neighbors, which are
     # also missed by path.contains_point()
-    for idx, neighbors in _node_neighbors.items():
-        if len(neighbors) <= 2:
-            vert2_mask[idx] = True
+    vert2_mask[(degree > 0) & (degree <= 2)] = True
 
     # Mask out elements containing the unwanted nodes.
     tria3_mask = np.any(vert2_mask[mesh.tria3['index']], axis=1)
@@ -151,30 +223,27 @@ def sieve(mesh, area=None):
     # isolated node removal does not require elimination of triangles from
     # the table, therefore the length of the indexes is constant.
     # We must simply renumber the tria3 indexes to match the new node indexes.
-    # Essentially subtract one, but going from the bottom of the index table
-    # to the top.
     used_indexes = np.unique(mesh.tria3['index'])
-    node_indexes = np.arange(mesh.vert2['coord'].shape[0])
-    tria3_idxs = np.where(~np.isin(node_indexes, used_indexes))[0]
     tria3_IDtag = mesh.tria3['IDtag'].take(np.where(~tria3_mask)[0])
-    tria3_index = mesh.tria3['index'][~tria3_mask, :].flatten()
-    for idx in reversed(tria3_idxs):
-        tria3_index[np.where(tria3_index >= idx)] -= 1
-    tria3_index = tria3_index.reshape((tria3_IDtag.shape[0], 3))
-    vert2_idxs = np.where(np.isin(node_indexes, used_indexes))[0]
-
-    # update vert2
-    mesh.vert2 = mesh.vert2.take(vert2_idxs, axis=0)
-
-    # update value
-    if len(mesh.value) > 0:
-        mesh.value = mesh.value.take(vert2_idxs)
+    tria3_index = renumber_index(
+        mesh.tria3['index'][~tria3_mask, :],
+        used_indexes,
+        mesh.vert2['coord'].shape[0])
+
+    # update vert2 and value, unless every vertex is kept
+    if used_indexes.size < mesh.vert2.shape[0]:
+        mesh.vert2 = mesh.vert2.take(used_indexes, axis=0)
+        if len(mesh.value) > 0:
+            mesh.value = mesh.value.take(used_indexes)
+    elif len(mesh.value) > 0:
+        # same 1-D shape take() returns, without the copy
+        mesh.value = mesh.value.ravel()
 
     # update tria3
-    mesh.tria3 = np.array(
-        [(tuple(indices), tria3_IDtag[i])
-         for i, indices in enumerate(tria3_index)],
-        dtype=jigsaw_msh_t.TRIA3_t)
+    mesh.tria3 = np.empty(tria3_IDtag.shape[0], dtype=jigsaw_msh_t.TRIA3_t)
+    mesh.tria3['index'] = tria3_index
+    mesh.tria3['IDtag'] = tria3_IDtag
+    _invalidate_tri(mesh)
 
 
 def sort_edges(edges):
@@ -182,118 +251,108 @@ def sort_edges(edges):
     if len(edges) == 0:
         return edges
 
+    # map each vertex to the edges starting (e0) and ending (e1) on it, in
+    # input order, so every lookup below is a dict access instead of a scan.
+    e0, e1 = dict(), dict()
+    for i, (v0, v1) in enumerate(edges):
+        e0.setdefault(v0, deque()).append(i)
+        e1.setdefault(v1, deque()).append(i)
+    used = [False] * len(edges)
+
+    def pop(table, vertex):
+        idxs = table.get(vertex)
+        if idxs is None:
+            return None
+        while len(idxs) > 0 and used[idxs[0]]:
+            idxs.popleft()
+        if len(idxs) == 0:
+            return None
+        idx = idxs.popleft()
+        used[idx] = True
+        return idx
+
     # start ordering the edges into linestrings
     edge_collection = list()
-    ordered_edges = [edges.pop(-1)]
-    e0, e1 = [list(t) for t in zip(*edges)]
-    while len(edges) > 0:
-
-        if ordered_edges[-1][1] in e0:
-            idx = e0.index(ordered_edges[-1][1])
-            ordered_edges.append(edges.pop(idx))
-
-        elif ordered_edges[0][0] in e1:
-            idx = e1.index(ordered_edges[0][0])
-            ordered_edges.insert(0, edges.pop(idx))
-
-        elif ordered_edges[-1][1] in e1:
-            idx = e1.index(ordered_edges[-1][1])
-            ordered_edges.append(
-                list(reversed(edges.pop(idx))))
-
-        elif ordered_edges[0][0] in e0:
-            idx = e0.index(ordered_edges[0][0])
-            ordered_edges.insert(
-                0, list(reversed(edges.pop(idx))))
-
+    seed = len(edges) - 1
+    used[seed] = True
+    ordered_edges = deque([edges[seed]])
+    for _ in range(len(edges) - 1):
+        for table, append, flip in [(e0, True, False), (e1, False, False),
+                                    (e1, True, True), (e0, False, True)]:
+            if append:
+                idx = pop(table, ordered_edges[-1][1])
+            else:
+                idx = pop(table, ordered_edges[0][0])
+            if idx is None:
+                continue
+            edge = list(reversed(edges[idx])) if flip else edges[idx]
+            if append:
+                ordered_edges.append(edge)
+            else:
+                ordered_edges.appendleft(edge)
+            break
         else:
             edge_collection.append(tuple(ordered_edges))
-            idx = -1
-            ordered_edges = [edges.pop(idx)]
-
-        e0.pop(idx)
-        e1.pop(idx)
+            while used[seed]:
+                seed -= 1
+            used[seed] = True
+            ordered_edges = deque([edges[seed]])
 
     # finalize
-    if len(edge_collection) == 0 and len(edges) == 0:
-        edge_collection.append(tuple(ordered_edges))
-    else:
-        edge_collection.append(tuple(ordered_edges))
+    edge_collection.append(tuple(ordered_edges))
 
     return edge_collection
 
 
+def _ring_path(vertices, ring):
+    """
+    Closed Path through the vertices of an (N, 2) ring of edge indexes.
+    Path(closed=True) ignores its last vertex, so the first is repeated.
+    """
+    return Path(vertices[np.append(ring[:, 0], ring[0, 0]), :], closed=True)
+
+
 def index_ring_collection(mesh):
 
     # find boundary edges using triangulation neighbors table,
     # see: https://stackoverflow.com/a/23073229/7432462
-    boundary_edges = list()
-    tri = mesh_to_tri(mesh)
-    idxs = np.vstack(
-        list(np.where(tri.neighbors == -1))).T
-    for i, j in idxs:
-        boundary_edges.append(
-            (int(tri.triangles[i, j]),
-                int(tri.triangles[i, (j+1) % 3])))
-    index_ring_collection = sort_edges(boundary_edges)
+    tri = _cached_tri(mesh)
+    i, j = np.where(tri.neighbors == -1)
+    boundary_edges = np.stack(
+        [tri.triangles[i, j], tri.triangles[i, (j+1) % 3]], axis=1)
+    index_ring_collection = sort_edges(boundary_edges.tolist())
     # sort index_rings into corresponding "polygons"
-    areas = list()
     vertices = mesh.vert2['coord']
-    for index_ring in index_ring_collection:
-        e0, e1 = [list(t) for t in zip(*index_ring)]
-        areas.append(float(Polygon(vertices[e0, :]).area))
-
-    # maximum area must be main mesh
-    idx = areas.index(np.max(areas))
-    exterior = index_ring_collection.pop(idx)
-    areas.pop(idx)
-    _id = 0
+    rings = [np.asarray(index_ring) for index_ring in index_ring_collection]
+    areas = [abs(float(signed_polygon_area(vertices[ring[:, 0], :])))
+             for ring in rings]
+    # contains[i, j] is True when ring i surrounds the first vertex of ring j;
+    # every ring path is built once and queried with all points at once.
+    reps = vertices[[ring[0, 0] for ring in rings], :]
+    contains = np.stack(
+        [_ring_path(vertices, ring).contains_points(reps) for ring in rings])
+    np.fill_diagonal(contains, False)
+    remaining = list(range(len(rings)))
+    _id = -1
     _index_ring_collection = dict()
-    _index_ring_collection[_id] = {
-        'exterior': np.asarray(exterior),
-        'interiors': []
-        }
-    e0, e1 = [list(t) for t in zip(*exterior)]
-    path = Path(vertices[e0 + [e0[0]], :], closed=True)
-    while len(index_ring_collection) > 0:
-        # find all internal rings
-        potential_interiors = list()
-        for i, index_ring in enumerate(index_ring_collection):
-            e0, e1 = [list(t) for t in zip(*index_ring)]
-            if path.contains_point(vertices[e0[0], :]):
-                potential_interiors.append(i)
-        # filter out nested rings
-        real_interiors = list()
-        for i, p_interior in reversed(list(enumerate(potential_interiors))):
-            _p_interior = index_ring_collection[p_interior]
-            check = [index_ring_collection[_]
-                     for j, _ in reversed(list(enumerate(potential_interiors)))
-                     if i != j]
-            has_parent = False
-            for _path in check:
-                e0, e1 = [list(t) for t in zip(*_path)]
-                _path = Path(vertices[e0 + [e0[0]], :], closed=True)
-                if _path.contains_point(vertices[_p_interior[0][0], :]):
-                    has_parent = True
-            if not has_parent:
-                real_interiors.append(p_interior)
-        # pop real rings from collection
-        for i in reversed(sorted(real_interiors)):
-            _index_ring_collection[_id]['interiors'].append(
-                np.asarray(index_ring_collection.pop(i)))
-            areas.pop(i)
-        # if no internal rings found, initialize next polygon
-        if len(index_ring_collection) > 0:
-            idx = areas.index(np.max(areas))
-            exterior = index_ring_collection.pop(idx)
-            areas.pop(idx)
-            _id += 1
-            _index_ring_collection[_id] = {
-                'exterior': np.asarray(exterior),
-                'interiors': []
-                }
-            e0, e1 = [list(t) for t in zip(*exterior)]
-            path = Path(vertices[e0 + [e0[0]], :], closed=True)
+    while len(remaining) > 0:
+        # maximum area must be main mesh
+        exterior = max(remaining, key=areas.__getitem__)
+        remaining.remove(exterior)
+        _id += 1
+        _index_ring_collection[_id] = {
+            'exterior': rings[exterior],
+            'interiors': []
+            }
+        # find all internal rings, filtering out nested ones
+        potential_interiors = [i for i in remaining if contains[exterior, i]]
+        has_parent = contains[np.ix_(
+            potential_interiors, potential_interiors)].any(axis=0)
+        real_interiors = [i for i, nested in zip(
+            potential_interiors, has_parent) if not nested]
+        for i in reversed(real_interiors):
+            _index_ring_collection[_id]['interiors'].append(rings[i])
+            remaining.remove(i)
     return _index_ring_collection
 
 
@@ -315,26 +374,69 @@ def inner_ring_collection(mesh):
 
 def signed_polygon_area(vertices):
     # https://code.activestate.com/recipes/578047-area-of-polygon-using-shoelace-formula/
-    n = len(vertices)  # of vertices
-    area = 0.0
-    for i in range(n):
-        j = (i + 1) % n
-        area += vertices[i][0] * vertices[j][1]
-        area -= vertices[j][0] * vertices[i][1]
-    return area / 2.0
+    vertices = np.asarray(vertices, dtype=float)
+    x = vertices[:, 0]
+    y = vertices[:, 1]
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+class CSRAdjacency:
+    """
+    Read-only adjacency table in compressed sparse row form: the entries of
+    row i are indices[offsets[i]:offsets[i+1]]. Supports the dict-like
+    access (adj[i], items(), len(adj)) of the defaultdict(set) tables it
+    replaces, where only rows with at least one entry count as keys.
+    """
+
+    def __init__(self, offsets, indices):
+        self.offsets = offsets
+        self.indices = indices
+
+    def __getitem__(self, i):
+        return self.indices[self.offsets[i]:self.offsets[i+1]]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, i):
+        return 0 <= i < self.offsets.size - 1 and \
+            self.offsets[i+1] > self.offsets[i]
+
+    def keys(self):
+        return np.where(np.diff(self.offsets) > 0)[0]
+
+    def values(self):
+        return (self[i] for i in self.keys())
+
+    def items(self):
+        return ((i, self[i]) for i in self.keys())
+
+
+def neighbors_csr(indexes, nverts):
+    """
+    Builds the vertex to vertex adjacency of the element index tables in
+    indexes (e.g. tria3, quad4 and hexa8 'index' arrays), where every pair
+    of vertices sharing an element are neighbors.
+    """
+    keys = list()
+    for index in indexes:
+        width = index.shape[1]
+        pairs = [(i, j) for i in range(width) for j in range(width) if i != j]
+        pairs = index[:, pairs].reshape(-1, 2).astype(np.int64)
+        keys.append(pairs[:, 0] * nverts + pairs[:, 1])
+    keys = np.unique(np.concatenate(keys))
+    offsets = np.searchsorted(keys // nverts, np.arange(nverts+1))
+    return CSRAdjacency(offsets, keys % nverts)
 
 
 def vertices_around_vertex(mesh):
     if mesh.mshID == 'euclidean-mesh':
-        def append(geom):
-            for simplex in geom['index']:
-                for i, j in permutations(simplex, 2):
-                    vertices_around_vertex[i].add(j)
-        vertices_around_vertex = defaultdict(set)
-        append(mesh.tria3)
-        append(mesh.quad4)
-        append(mesh.hexa8)
-        return vertices_around_vertex
+        return neighbors_csr(
+            [mesh.tria3['index'], mesh.quad4['index'], mesh.hexa8['index']],
+            mesh.vert2.shape[0])
     else:
         msg = f"Not implemented for mshID={mesh.mshID}"
         raise NotImplementedError(msg)
@@ -360,80 +462,119 @@ def must_be_euclidean_mesh(f):
     return decorator
 
 
+@must_be_euclidean_mesh
+def element_ids(mesh):
+    """
+    IDtags of the tria3, quad4 and hexa8 elements, in that order. Falls back
+    to sequential ids starting on 1 if the IDtags are not unique.
+    """
+    elements_id = np.concatenate(
+        [mesh.tria3['IDtag'], mesh.quad4['IDtag'], mesh.hexa8['IDtag']])
+    if np.unique(elements_id).size != elements_id.size:
+        elements_id = np.arange(1, elements_id.size+1)
+    return elements_id
+
+
 @must_be_euclidean_mesh
 def elements(mesh):
-    elements_id = list()
-    elements_id.extend(list(mesh.tria3['IDtag']))
-    elements_id.extend(list(mesh.quad4['IDtag']))
-    elements_id.extend(list(mesh.hexa8['IDtag']))
-    elements_id = range(1, len(elements_id)+1) \
-        if len(set(elements_id)) != len(elements_id) else elements_id
-    elements = list()
-    elements.extend(list(mesh.tria3['index']))
-    elements.extend(list(mesh.quad4['index']))
-    elements.extend(list(mesh.hexa8['index']))
-    elements = {
-        elements_id[i]: indexes for i, indexes in enumerate(elements)}
-    return elements
+    return dict(zip(
+        element_ids(mesh).tolist(),
+        chain(mesh.tria3['index'], mesh.quad4['index'], mesh.hexa8['index'])
+        ))
 
 
 @must_be_euclidean_mesh
 def faces_around_vertex(mesh):
-    _elements = elements(mesh)
-    length = max(map(len, _elements.values()))
-    y = np.array([xi+[-99999]*(length-len(xi)) for xi in _elements.values()])
-    print(y)
-    faces_around_vertex = defaultdict(set)
-    for i, coord in enumerate(mesh.vert2['index']):
-        np.isin(i, axis=0)
-        faces_around_vertex[i].add()
-
-    faces_around_vertex = defaultdict(set)
-
-
-def has_pinched_nodes(mesh):
-    _inner_ring_collection = inner_ring_collection(mesh)
-    all_nodes = list()
-    for inner_rings in _inner_ring_collection.values():
-        for ring in inner_rings:
-            all_nodes.extend(np.asarray(ring)[:, 0].tolist())
-    u, c = np.unique(all_nodes, return_counts=True)
-    if len(u[c > 1]) > 0:
+    """
+    Elements around each vertex, as a CSRAdjacency. Elements are numbered by
+    position across the tria3, quad4 and hexa8 tables, in that order.
+    """
+    vertices = list()
+    faces = list()
+    offset = 0
+    for index in [mesh.tria3['index'], mesh.quad4['index'],
+                  mesh.hexa8['index']]:
+        vertices.append(index.ravel())
+        faces.append(np.repeat(
+            np.arange(offset, offset+index.shape[0]), index.shape[1]))
+        offset += index.shape[0]
+    vertices = np.concatenate(vertices)
+    order = np.argsort(vertices, kind='stable')
+    offsets = np.searchsorted(
+        vertices[order], np.arange(mesh.vert2.shape[0]+1))
+    return CSRAdjacency(offsets, np.concatenate(faces)[order])
+
+
+def _pinched_nodes(ring_collection):
+    all_nodes = [ring[:, 0] for rings in ring_collection.values()
+                 for ring in rings['interiors']]
+    if len(all_nodes) == 0:
+        return np.empty((0,), dtype=int)
+    u, c = np.unique(np.concatenate(all_nodes), return_counts=True)
+    return u[c > 1]
+
+
+def has_pinched_nodes(mesh, ring_collection=None):
+    if ring_collection is None:
+        ring_collection = index_ring_collection(mesh)
+    if len(_pinched_nodes(ring_collection)) > 0:
         return True
     else:
         return False
 
 
-def cleanup_pinched_nodes(mesh):
-    _inner_ring_collection = inner_ring_collection(mesh)
-    all_nodes = list()
-    for inner_rings in _inner_ring_collection.values():
-        for ring in inner_rings:
-            all_nodes.extend(np.asarray(ring)[:, 0].tolist())
-    u, c = np.unique(all_nodes, return_counts=True)
-    mesh.tria3 = mesh.tria3.take(
-        np.where(
-            ~np.any(np.isin(mesh.tria3['index'], u[c > 1]), axis=1))[0],
-        axis=0)
+def cleanup_pinched_nodes(mesh, ring_collection=None):
+    if ring_collection is None:
+        ring_collection = index_ring_collection(mesh)
+    pinched_nodes = _pinched_nodes(ring_collection)
+    tria3_mask = np.isin(mesh.tria3['index'], pinched_nodes).any(axis=1)
+    mesh.tria3 = mesh.tria3[~tria3_mask]
+    _invalidate_tri(mesh)
+
+
+def _grid_spacing(grid):
+    """
+    Returns the spacing of grid if it is uniformly spaced, else None.
+    """
+    if grid.size < 2:
+        return None
+    step = (grid[-1] - grid[0]) / (grid.size - 1)
+    if step <= 0 or not np.allclose(np.diff(grid), step):
+        return None
+    return step
 
 
 def interpolate_hmat(mesh, hmat, method='spline', kx=1, ky=1, **kwargs):
     assert isinstance(mesh, jigsaw_msh_t)
     assert isinstance(hmat, jigsaw_msh_t)
     assert method in ['spline', 'linear', 'nearest']
-    kwargs.update({'kx': kx, 'ky': ky})
     if method == 'spline':
-        values = RectBivariateSpline(
-            hmat.xgrid,
-            hmat.ygrid,
-            hmat.value.T,
-            **kwargs
-            ).ev(
-            mesh.vert2['coord'][:, 0],
-            mesh.vert2['coord'][:, 1])
-        mesh.value = np.array(
-            values.reshape((values.size, 1)),
-            dtype=jigsaw_msh_t.REALS_t)
+        x = mesh.vert2['coord'][:, 0]
+        y = mesh.vert2['coord'][:, 1]
+        dx = _grid_spacing(hmat.xgrid)
+        dy = _grid_spacing(hmat.ygrid)
+        if kx == 1 and ky == 1 and len(kwargs) == 0 \
+                and dx is not None and dy is not None:
+            # bilinear spline on a regular grid; same result as the spline
+            # below (which also clamps points outside the grid to its edge)
+            # without the spline setup.
+            values = map_coordinates(
+                hmat.value,
+                [(y - hmat.ygrid[0]) / dy, (x - hmat.xgrid[0]) / dx],
+                output=np.float64,
+                order=1,
+                mode='nearest')
+        else:
+            values = RectBivariateSpline(
+                hmat.xgrid,
+                hmat.ygrid,
+                hmat.value.T,
+                kx=kx,
+                ky=ky,
+                **kwargs
+                ).ev(x, y)
+        mesh.value = values.reshape((values.size, 1)).astype(
+            jigsaw_msh_t.REALS_t, copy=False)
     else:
         raise NotImplementedError("Only 'spline' method is available")
 
@@ -444,17 +585,15 @@ def tricontourf(
     show=False,
     figsize=None,
     extend='both',
+    tri=None,
     **kwargs
 ):
     if ax is None:
         fig = plt.figure(figsize=figsize)
         ax = fig.add_subplot(111)
-    ax.tricontourf(
-        mesh.vert2['coord'][:, 0],
-        mesh.vert2['coord'][:, 1],
-        mesh.tria3['index'],
-        mesh.value.flatten(),
-        **kwargs)
+    if tri is None:
+        tri = mesh_to_tri(mesh)
+    ax.tricontourf(tri, mesh.value.flatten(), **kwargs)
     if show:
         plt.gca().axis('scaled')
         plt.show()
@@ -468,62 +607,70 @@ def triplot(
     figsize=None,
     color='k',
     linewidth=0.07,
+    tri=None,
     **kwargs
 ):
     if axes is None:
         fig = plt.figure(figsize=figsize)
         axes = fig.add_subplot(111)
-    axes.triplot(
-        mesh.vert2['coord'][:, 0],
-        mesh.vert2['coord'][:, 1],
-        mesh.tria3['index'],
-        color=color,
-        linewidth=linewidth,
-        **kwargs)
+    if tri is None:
+        tri = mesh_to_tri(mesh)
+    axes.triplot(tri, color=color, linewidth=linewidth, **kwargs)
     if show:
         axes.axis('scaled')
         plt.show()
     return axes
 
 
-def limgrad(mesh, dfdx, imax=100):
-    """
-    See https://github.com/dengwirda/mesh2d/blob/master/hjac-util/limgrad.m
-    for original source code.
-    """
-    tri = mesh_to_tri(mesh)
-    xy = np.vstack([tri.x, tri.y]).T
-    edge = tri.edges
-    dx = np.subtract(xy[edge[:, 0], 0], xy[edge[:, 1], 0])
-    dy = np.subtract(xy[edge[:, 0], 1], xy[edge[:, 1], 1])
-    elen = np.sqrt(dx**2+dy**2)
-    ffun = mesh.value.flatten()
-    aset = np.zeros(ffun.shape)
-    ftol = np.min(ffun) * np.sqrt(np.finfo(float).eps)
-    # precompute neighbor table
-    point_neighbors = defaultdict(set)
-    for simplex in tri.triangles:
-        for i, j in permutations(simplex, 2):
-            point_neighbors[i].add(j)
-    # iterative smoothing
+@njit(cache=True)
+def _limgrad_kernel(
+    ffun, aset, nbr_offsets, nbr_indices, nbr_edge_len, dfdx, ftol, imax
+):
+    _iter = 0
     for _iter in range(1, imax+1):
         aidx = np.where(aset == _iter-1)[0]
-        if len(aidx) == 0.:
+        if len(aidx) == 0:
             break
-        active_idxs = np.argsort(ffun[aidx])
+        active_idxs = aidx[np.argsort(ffun[aidx])]
         for active_idx in active_idxs:
-            adjacent_edges = point_neighbors[active_idx]
-            for adj_edge in adjacent_edges:
+            for k in range(nbr_offsets[active_idx], nbr_offsets[active_idx+1]):
+                adj_edge = nbr_indices[k]
                 if ffun[adj_edge] > ffun[active_idx]:
-                    fun1 = ffun[active_idx] + elen[active_idx] * dfdx
+                    fun1 = ffun[active_idx] + nbr_edge_len[k] * dfdx
                     if ffun[adj_edge] > fun1+ftol:
                         ffun[adj_edge] = fun1
                         aset[adj_edge] = _iter
                 else:
-                    fun2 = ffun[adj_edge] + elen[active_idx] * dfdx
+                    fun2 = ffun[adj_edge] + nbr_edge_len[k] * dfdx
                     if ffun[active_idx] > fun2+ftol:
                         ffun[active_idx] = fun2
                         aset[active_idx] = _iter
+    return _iter
+
+
+def limgrad(mesh, dfdx, imax=100):
+    """
+    See https://github.com/dengwirda/mesh2d/blob/master/hjac-util/limgrad.m
+    for original source code.
+    """
+    tri = _cached_tri(mesh)
+    # smooth in double precision; rounding updates back to REALS_t can make
+    # the active set cycle without converging.
+    ffun = mesh.value.ravel().astype(np.float64)
+    aset = np.zeros(ffun.shape)
+    ftol = np.min(ffun) * np.sqrt(np.finfo(float).eps)
+    # precompute neighbor table, along with the length of the edge joining
+    # each vertex to each of its neighbors
+    point_neighbors = neighbors_csr([tri.triangles], ffun.shape[0])
+    rows = np.repeat(
+        np.arange(ffun.shape[0]), np.diff(point_neighbors.offsets))
+    nbr_edge_len = np.hypot(
+        tri.x[rows] - tri.x[point_neighbors.indices],
+        tri.y[rows] - tri.y[point_neighbors.indices])
+    # iterative smoothing
+    _iter = _limgrad_kernel(
+        ffun, aset, point_neighbors.offsets, point_neighbors.indices,
+        nbr_edge_len, dfdx, ftol, imax)
     if not _iter < imax:
         msg = f'limgrad() did not converge within {imax} iterations.'
         raise Exception(msg)
@@ -102,6 +102,7 @@ setuptools.setup(
     install_requires=[
                       "jigsawpy",
                       "matplotlib",
+                      "numba",
                       "netCDF4",
                       "scipy",
                       "pyproj>=2.6",